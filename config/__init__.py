@@ -36,6 +36,14 @@ class MuZeroConfig(object):
         self.num_simulations = num_simulations
         self.discount = discount
 
+        # Self-play can run on a copy of the network with weights cast to e.g. 'bfloat16',
+        # which halves the weight traffic of each inference on CPUs with native support.
+        self.selfplay_dtype = 'float32'
+        # Self-play inference runs at batch num_actors, too small to be worth the trips to the GPU,
+        # which is left to training. Without a GPU, soft placement puts training on the CPU.
+        self.selfplay_device = '/CPU:0'
+        self.training_device = '/GPU:0'
+
         # Root prior exploration noise.
         self.root_dirichlet_alpha = dirichlet_alpha
         self.root_exploration_fraction = 0.25
@@ -52,8 +60,6 @@ class MuZeroConfig(object):
 
         # Training
         self.training_steps = training_steps
-        self.epochs = 5000
-        self.checkpoint_interval = 100
         self.window_size = 125000
         self.batch_size = batch_size
         self.num_unroll_steps = 5
@@ -62,6 +68,9 @@ class MuZeroConfig(object):
 
         self.weight_decay = 1e-4
         self.momentum = 0.9
+        # Keras dtype policy of the trained network. 'mixed_float16' keeps float32 weights
+        # with float16 activations (and loss scaling), for GPUs with tensor cores.
+        self.training_dtype = 'float32'
 
         # Exponential learning rate schedule
         self.lr_init = lr_init
@@ -1,32 +1,24 @@
 from collections import deque
-from random import randrange, choice
-from typing import List
+from functools import lru_cache
+from threading import Event, Lock
+from typing import List, NamedTuple, Tuple
 
 import gym
 import numpy as np
 from gym import Env
 
 from config import MuZeroConfig
-from utils import Node
+from utils import SearchTree
 
 
 class Player(object):
     pass
 
 
-class Action(object):
-
-    def __init__(self, index: int):
-        self.index = index
-
-    def __hash__(self):
-        return self.index
-
-    def __eq__(self, other):
-        return self.index == other.index
-
-    def __gt__(self, other):
-        return self.index > other.index
+@lru_cache(maxsize=None)
+def action_space(action_space_size: int) -> Tuple[int, ...]:
+    # Actions are plain indexes. Shared by every game and search tree, so it is built once per size.
+    return tuple(range(action_space_size))
 
 
 class ActionHistory(object):
@@ -35,21 +27,21 @@ class ActionHistory(object):
   Only used to keep track of the actions executed.
   """
 
-    def __init__(self, history: List[Action], action_space_size: int):
+    def __init__(self, history: List[int], action_space_size: int):
         self.history = list(history)
         self.action_space_size = action_space_size
 
     def clone(self):
         return ActionHistory(self.history, self.action_space_size)
 
-    def add_action(self, action: Action):
+    def add_action(self, action: int):
         self.history.append(action)
 
-    def last_action(self) -> Action:
+    def last_action(self) -> int:
         return self.history[-1]
 
-    def action_space(self) -> List[Action]:
-        return [Action(i) for i in range(self.action_space_size)]
+    def action_space(self) -> Tuple[int, ...]:
+        return action_space(self.action_space_size)
 
     def to_play(self) -> Player:
         return Player()
@@ -63,29 +55,48 @@ class Environment(object):
         self.action_space_size = self.env.action_space.n
 
     def reset(self):
-        return self.env.reset()
+        return self.prepare_observation(self.env.reset())
 
     def step(self, action):
         observation, reward, done, info = self.env.step(action)
-        return observation, reward, done, info
+        return self.prepare_observation(observation), reward, done, info
+
+    @staticmethod
+    def prepare_observation(observation) -> np.ndarray:
+        # Observations are kept as [1, obs_dim] float32, the shape the network consumes.
+        return np.reshape(observation, (1, -1)).astype(np.float32)
 
     def close(self):
         self.env.close()
 
 
+class GameRecord(NamedTuple):
+    """The per-move arrays of a finished game, as stored in the replay buffer."""
+    observations: np.ndarray
+    actions: np.ndarray
+    rewards: np.ndarray
+    child_visits: np.ndarray
+    value_targets: np.ndarray
+
+
 class Game(object):
     """A single episode of interaction with the environment."""
 
-    def __init__(self, discount: float):
+    def __init__(self, discount: float, max_moves: int):
         self.env = Environment()
-        self.states = [self.env.reset()]
-        self.history = []
-        self.rewards = []
-        self.child_visits = []
-        self.root_values = []
+        observation = self.env.reset()
         self.action_space_size = self.env.action_space_size
+
+        # Per-move records, preallocated for the longest game and filled up to step_idx.
+        self.states = np.empty((max_moves + 1, observation.shape[1]), dtype=np.float32)
+        self.states[0] = observation[0]
+        self.history = np.empty(max_moves, dtype=np.int32)
+        self.rewards = np.empty(max_moves, dtype=np.float32)
+        self.child_visits = np.zeros((max_moves, self.action_space_size), dtype=np.float32)
+        self.root_values = np.empty(max_moves, dtype=np.float32)
+        self.step_idx = 0
+
         self.discount = discount
-        self.actions = list(map(lambda i: Action(i), range(self.action_space_size)))
         self.done = False
 
     def terminal(self) -> bool:
@@ -95,97 +106,164 @@ class Game(object):
 
         return self.done
 
-    def legal_actions(self) -> List[Action]:
+    def legal_actions(self) -> Tuple[int, ...]:
         # Game specific calculation of legal actions.
-        return self.actions
+        return action_space(self.action_space_size)
 
-    def apply(self, action: Action):
-        observation, reward, done, info = self.env.step(action.index)
+    def apply(self, action: int):
+        observation, reward, done, info = self.env.step(action)
         self.done = done
-        self.states.append(observation)
-        self.rewards.append(reward)
-        self.history.append(action)
-
-    def store_search_statistics(self, root: Node):
-        sum_visits = sum(child.visit_count for child in root.children.values())
-        action_space = (Action(index) for index in range(self.action_space_size))
-        self.child_visits.append([
-            root.children[a].visit_count / sum_visits if a in root.children else 0
-            for a in action_space
-        ])
-        self.root_values.append(root.value())
-
-    def make_image(self, state_index: int):
-        # Game specific feature planes.
-        return self.states[state_index]
-
-    def make_target(self, state_index: int, num_unroll_steps: int, td_steps: int,
-                    to_play: Player):
+        self.rewards[self.step_idx] = reward
+        self.history[self.step_idx] = action
+        self.step_idx += 1
+        self.states[self.step_idx] = observation[0]
+
+    def store_search_statistics(self, tree: SearchTree):
+        # Statistics of the search run before the next move is applied.
+        children = tree.children[SearchTree.ROOT]
+        visits = np.where(children >= 0, tree.visit_count[children], 0)
+        self.child_visits[self.step_idx] = visits / visits.sum()
+        self.root_values[self.step_idx] = tree.value(SearchTree.ROOT)
+
+    def make_image(self, state_index: int) -> np.ndarray:
+        # Game specific feature planes, as a [1, obs_dim] view.
+        return self.states[state_index:state_index + 1]
+
+    def make_value_targets(self, td_steps: int) -> np.ndarray:
         # The value target is the discounted root value of the search tree N steps
         # into the future, plus the discounted sum of all rewards until then.
-        targets = []
-        for current_index in range(state_index, state_index + num_unroll_steps + 1):
-            bootstrap_index = current_index + td_steps
-            if bootstrap_index < len(self.root_values):
-                value = self.root_values[bootstrap_index] * self.discount ** td_steps
-            else:
-                value = 0
-
-            for i, reward in enumerate(self.rewards[current_index:bootstrap_index]):
-                value += reward * self.discount ** i  # pytype: disable=unsupported-operands
-
-            if 0 < current_index <= len(self.rewards):
-                last_reward = self.rewards[current_index - 1]
-            else:
-                last_reward = None
-
-            if current_index < len(self.root_values):
-                targets.append((value, last_reward, self.child_visits[current_index]))
-            else:
-                # States past the end of games are treated as absorbing states.
-                targets.append((0, last_reward, []))
-        return targets
+        discounts = self.discount ** np.arange(td_steps + 1, dtype=np.float32)
+        rewards = self.rewards[:self.step_idx]
+        root_values = self.root_values[:self.step_idx]
+
+        padded = np.concatenate([rewards, np.zeros(td_steps, dtype=np.float32)])
+        values = np.correlate(padded, discounts[:td_steps], mode='valid')[:len(rewards)]
+        values[:max(len(rewards) - td_steps, 0)] += root_values[td_steps:] * discounts[td_steps]
+        return values
 
     def to_play(self) -> Player:
         return Player()
 
+    def to_record(self, td_steps: int) -> GameRecord:
+        length = self.step_idx
+        return GameRecord(observations=self.states[:length],
+                          actions=self.history[:length],
+                          rewards=self.rewards[:length],
+                          child_visits=self.child_visits[:length],
+                          value_targets=self.make_value_targets(td_steps))
+
     def action_history(self) -> ActionHistory:
-        return ActionHistory(self.history, self.action_space_size)
+        return ActionHistory(self.history[:self.step_idx].tolist(), self.action_space_size)
+
+
+class Batch(NamedTuple):
+    observations: np.ndarray
+    actions: np.ndarray
+    target_values: np.ndarray
+    target_rewards: np.ndarray
+    target_policies: np.ndarray
+    mask: np.ndarray
 
 
 class ReplayBuffer(object):
+    """Ring buffer of game positions stored as preallocated NumPy arrays.
+
+    Finished game records are staged in buffer_tmp by the self-play worker and only
+    copied into the arrays on update_main. Batches may be sampled ahead on another
+    thread, so writes and samples are serialized by a lock.
+    """
 
     def __init__(self, config: MuZeroConfig):
         self.window_size = config.window_size
         self.batch_size = config.batch_size
-        self.buffer = deque(maxlen=self.window_size)
+        self.capacity = config.window_size * config.max_moves
         self.buffer_tmp = deque(maxlen=self.window_size)
 
+        self.obs_buf = np.empty((self.capacity, config.state_space_size), dtype=np.float32)
+        self.rew_buf = np.empty(self.capacity, dtype=np.float32)
+        self.val_buf = np.empty(self.capacity, dtype=np.float32)
+        self.vis_buf = np.empty((self.capacity, config.action_space_size), dtype=np.float32)
+        self.act_buf = np.empty(self.capacity, dtype=np.int32)
+        # Number of positions left in the game, counting the position itself.
+        self.left_buf = np.empty(self.capacity, dtype=np.int32)
+
+        self.pos = 0
+        self.size = 0
+        # Lengths of the games still in the ring, oldest first, and their total.
+        self.game_lengths = deque()
+        self.game_positions = 0
+        self.lock = Lock()
+        # Set once the first game has been staged, so the trainer can wait without polling.
+        self.ready = Event()
+
     def update_main(self):
         """
-        Update self.buffer with recent played games
+        Copy recent played games into the main buffer
         :return: None
         """
-        self.buffer += self.buffer_tmp
-        self.buffer_tmp.clear()
-
-    def save_game(self, game):
-        self.buffer_tmp.append(game)
-
-    def sample_batch(self, num_unroll_steps: int, td_steps: int):
-        games = [self.sample_game() for _ in range(self.batch_size)]
-        game_pos = [(g, self.sample_position(g)) for g in games]
-        return [(g.make_image(i), g.history[i:i + num_unroll_steps],
-                 g.make_target(i, num_unroll_steps, td_steps, g.to_play()))
-                for (g, i) in game_pos]
-
-    def sample_game(self) -> Game:
-        return np.random.choice(self.buffer)
-        #return choice(self.buffer)
-
-    def sample_position(self, game) -> int:
-        return np.random.choice(len(game.history))
-        #return randrange(len(game.history))
+        with self.lock:
+            while self.buffer_tmp:
+                self.write_game(self.buffer_tmp.popleft())
+
+    def save_game(self, record: GameRecord):
+        self.buffer_tmp.append(record)
+        self.ready.set()
+
+    def write_game(self, record: GameRecord):
+        length = len(record.actions)
+        idx = (self.pos + np.arange(length)) % self.capacity
+        self.obs_buf[idx] = record.observations
+        self.rew_buf[idx] = record.rewards
+        self.val_buf[idx] = record.value_targets
+        self.vis_buf[idx] = record.child_visits
+        self.act_buf[idx] = record.actions
+        self.left_buf[idx] = length - np.arange(length)
+
+        self.pos = (self.pos + length) % self.capacity
+        self.size = min(self.size + length, self.capacity)
+        self.game_lengths.append(length)
+        self.game_positions += length
+        # Games whose first positions were overwritten no longer count as in the window.
+        while self.game_positions > self.capacity:
+            self.game_positions -= self.game_lengths.popleft()
+
+    @property
+    def num_games(self) -> int:
+        """Number of games currently in the window."""
+        return len(self.game_lengths)
+
+    def sample_batch(self, num_unroll_steps: int) -> Batch:
+        with self.lock:
+            return self._sample_batch(num_unroll_steps)
+
+    def _sample_batch(self, num_unroll_steps: int) -> Batch:
+        index = np.random.randint(0, self.size, self.batch_size)
+        left = self.left_buf[index][:, None]
+        unroll = np.arange(num_unroll_steps + 1)
+        mask = unroll < left
+
+        # Value targets are computed once per game when it is recorded. Positions past
+        # the end of the game are masked out, as the buffer holds other games
+        # (or uninitialized memory) there.
+        unroll_idx = (index[:, None] + unroll) % self.capacity
+        target_values = np.where(mask, self.val_buf[unroll_idx], 0.)
+
+        # Reward observed when reaching the k-th unrolled state.
+        last_reward_idx = (index[:, None] + unroll - 1) % self.capacity
+        target_rewards = np.where((unroll > 0) & (unroll <= left), self.rew_buf[last_reward_idx], 0.)
+
+        target_policies = np.where(mask[..., None], self.vis_buf[unroll_idx], 0.)
+
+        # States past the end of games are treated as absorbing states.
+        actions_idx = (index[:, None] + unroll[:-1]) % self.capacity
+        actions = np.where(unroll[:-1] < left, self.act_buf[actions_idx], 0)
+
+        return Batch(observations=self.obs_buf[index],
+                     actions=actions.astype(np.int32),
+                     target_values=target_values.astype(np.float32),
+                     target_rewards=target_rewards.astype(np.float32),
+                     target_policies=target_policies.astype(np.float32),
+                     mask=mask)
 
 
 def make_atari_config(env: Env) -> MuZeroConfig:
@@ -1,40 +1,53 @@
-from typing import List
+from typing import List, Sequence
 
 import math
 import numpy as np
 
 from config import MuZeroConfig
-from games.game import ActionHistory, Player, Action
-from models import NetworkOutput
+from games.game import ActionHistory
 from models.network import Network
-from utils import MinMaxStats, Node
+from utils import SearchTree
 
 
 # Core Monte Carlo Tree Search algorithm.
 # To decide on an action, we run N simulations, always starting at the root of
 # the search tree and traversing the tree according to the UCB formula until we
 # reach a leaf node.
-def run_mcts(config: MuZeroConfig, root: Node, action_history: ActionHistory,
-             network: Network, min_max_stats: MinMaxStats):
+# Several independent trees (one per concurrent game) are searched in lockstep:
+# each simulation selects one leaf per tree and evaluates all of them with a
+# single batched network call.
+def run_mcts(config: MuZeroConfig, trees: List[SearchTree], action_histories: List[ActionHistory],
+             network: Network):
     for _ in range(config.num_simulations):
-        history = action_history.clone()
-        node = root
-        search_path = [node]
+        histories = []
+        search_paths = []
+        for tree, action_history in zip(trees, action_histories):
+            history = action_history.clone()
+            node = SearchTree.ROOT
+            search_path = [node]
 
-        while node.expanded():
-            action, node = select_child(config, node, min_max_stats)
-            history.add_action(action)
-            search_path.append(node)
+            while tree.expanded[node]:
+                action, node = select_child(config, tree, node)
+                history.add_action(action)
+                search_path.append(node)
+
+            histories.append(history)
+            search_paths.append(search_path)
 
         # Inside the search tree we use the dynamics function to obtain the next
         # hidden state given an action and the previous hidden state.
-        parent = search_path[-2]
-        network_output = network.recurrent_inference(parent.hidden_state,
-                                                     history.last_action())
-        expand_node(node, history.to_play(), history.action_space(), network_output)
+        hidden_states = np.stack([tree.hidden_state[search_path[-2]]
+                                  for tree, search_path in zip(trees, search_paths)])
+        actions = [history.last_action() for history in histories]
+        # Padded to num_actors, so trees of games that already finished do not change the compiled shape.
+        policy_logits, values, rewards, next_hidden_states = network.recurrent_inference_batch(
+            hidden_states, actions, batch_size=config.num_actors)
+
+        for i, (tree, history, search_path) in enumerate(zip(trees, histories, search_paths)):
+            expand_node(tree, search_path[-1], history.action_space(),
+                        rewards[i], policy_logits[i], next_hidden_states[i])
 
-        backpropagate(search_path, network_output.value, history.to_play(),
-                      config.discount, min_max_stats)
+            backpropagate(tree, search_path, values[i], config.discount)
 
 
 def visit_softmax_temperature(training_steps):
@@ -46,74 +59,90 @@ def visit_softmax_temperature(training_steps):
         return 0.15
 
 
-def select_action(node: Node, network: Network):
-    visit_counts = [
-        (child.visit_count, action) for action, child in node.children.items()
-    ]
+def select_action(tree: SearchTree, network: Network):
+    children = tree.children[SearchTree.ROOT]
+    actions = np.flatnonzero(children >= 0)
+    visit_counts = list(zip(tree.visit_count[children[actions]].tolist(), actions.tolist()))
     t = visit_softmax_temperature(training_steps=network.training_steps())
     action = softmax_sample(visit_counts, t)
     return action
 
 
-# Select the child with the highest UCB score.
-def select_child(config: MuZeroConfig, node: Node,
-                 min_max_stats: MinMaxStats):
-    _, action, child = max(
-        (ucb_score(config, node, child, min_max_stats), action,
-         child) for action, child in node.children.items())
-    return action, child
+# Select the child with the highest UCB score, scored for all actions at once.
+def select_child(config: MuZeroConfig, tree: SearchTree, node: int):
+    children = tree.children[node]
+    scores = np.where(children >= 0, ucb_score(config, tree, node, children), -np.inf)
+    # Ties go to the highest action.
+    action = len(scores) - 1 - int(np.argmax(scores[::-1]))
+    return action, int(children[action])
 
 
 # The score for a node is based on its value, plus an exploration bonus based on
 # the prior.
-def ucb_score(config: MuZeroConfig, parent: Node, child: Node,
-              min_max_stats: MinMaxStats) -> float:
-    pb_c = math.log((parent.visit_count + config.pb_c_base + 1) /
+def ucb_score(config: MuZeroConfig, tree: SearchTree, parent: int, children: np.ndarray) -> np.ndarray:
+    parent_visit_count = tree.visit_count[parent]
+    child_visit_count = tree.visit_count[children]
+    pb_c = math.log((parent_visit_count + config.pb_c_base + 1) /
                     config.pb_c_base) + config.pb_c_init
-    pb_c *= math.sqrt(parent.visit_count) / (child.visit_count + 1)
+    pb_c = pb_c * math.sqrt(parent_visit_count) / (child_visit_count + 1)
 
-    prior_score = pb_c * child.prior
-    if child.visit_count > 0:
-        value_score = min_max_stats.normalize(child.reward +
-                                              config.discount * child.value())
-    else:
-        value_score = 0
+    prior_score = pb_c * tree.prior[children]
+    value_score = np.where(child_visit_count > 0,
+                           tree.min_max_stats.normalize(tree.reward[children] +
+                                                        config.discount * tree.value(children)),
+                           0.)
     return prior_score + value_score
 
 
 # We expand a node using the value, reward and policy prediction obtained from
 # the neural network.
-def expand_node(node: Node, to_play: Player, actions: List[Action],
-                network_output: NetworkOutput):
-    node.to_play = to_play
-    node.hidden_state = network_output.hidden_state
-    node.reward = network_output.reward
-    policy = {a: math.exp(network_output.policy_logits[a]) for a in actions}
-    policy_sum = sum(policy.values())
-    for action, p in policy.items():
-        node.children[action] = Node(p / policy_sum)
+def expand_node(tree: SearchTree, node: int, actions: Sequence[int], reward: float,
+                policy_logits: np.ndarray, hidden_state: np.ndarray):
+    actions = np.asarray(actions)
+    tree.hidden_state[node] = hidden_state
+    tree.reward[node] = reward
+    logits = policy_logits[actions]
+    policy = np.exp(logits - logits.max())
+    policy /= policy.sum()
+
+    children = np.arange(tree.num_nodes, tree.num_nodes + len(actions))
+    tree.children[node, actions] = children
+    tree.prior[children] = policy
+    tree.expanded[node] = True
+    tree.num_nodes += len(actions)
 
 
 # At the end of a simulation, we propagate the evaluation all the way up the
 # tree to the root.
-def backpropagate(search_path: List[Node], value: float, to_play: Player,
-                  discount: float, min_max_stats: MinMaxStats):
-    for node in reversed(search_path):
-        node.value_sum += value if node.to_play == to_play else -value
-        node.visit_count += 1
-        min_max_stats.update(node.value())
-
-        value = node.reward + discount * value
-
-
-# At the start of each search, we add dirichlet noise to the prior of the root
-# to encourage the search to explore new actions.
-def add_exploration_noise(config: MuZeroConfig, node: Node):
-    actions = list(node.children.keys())
+def backpropagate(tree: SearchTree, search_path: List[int], value: float, discount: float):
+    nodes = np.asarray(search_path[::-1])
+    values = []
+    for reward in tree.reward[nodes].tolist():
+        values.append(value)
+        value = reward + discount * value
+
+    tree.value_sum[nodes] += values
+    tree.visit_count[nodes] += 1
+    node_values = tree.value(nodes)
+    tree.min_max_stats.update(node_values.max())
+    tree.min_max_stats.update(node_values.min())
+
+
+# At the start of each search, the root is expanded, its value backed up and
+# dirichlet noise added to its prior to encourage the search to explore new
+# actions.
+def initialize_root(config: MuZeroConfig, tree: SearchTree, actions: Sequence[int], value: float,
+                    policy_logits: np.ndarray, hidden_state: np.ndarray):
+    root = SearchTree.ROOT
+    expand_node(tree, root, actions, 0., policy_logits, hidden_state)
+    children = tree.children[root, np.asarray(actions)]
     noise = np.random.dirichlet([config.root_dirichlet_alpha] * len(actions))
     frac = config.root_exploration_fraction
-    for a, n in zip(actions, noise):
-        node.children[a].prior = node.children[a].prior * (1 - frac) + n * frac
+    tree.prior[children] = tree.prior[children] * (1 - frac) + noise * frac
+
+    tree.value_sum[root] = value
+    tree.visit_count[root] = 1
+    tree.min_max_stats.update(value)
 
 
 # Stubs to make the typechecker happy.
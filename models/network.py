@@ -1,140 +1,124 @@
 from abc import ABC
 from pathlib import Path
-from typing import Callable, List
+from typing import List, Optional, Tuple
 
+import numpy as np
 import tensorflow as tf
 from tensorflow.keras.initializers import Zeros, RandomUniform
 from tensorflow.keras.layers import Dense
+from tensorflow.keras.mixed_precision import Policy
 from tensorflow.keras.models import Model
 
 from config import MuZeroConfig
-from games.game import Action
-from models import NetworkOutput
 from utils import tf_support_to_scalar
 
 
-def scale(t: tf.Tensor):
-    return (t - tf.reduce_min(t)) / (tf.reduce_max(t) - tf.reduce_min(t))
-
-
-def build_policy_logits(policy_logits):
-    return {Action(i): logit for i, logit in enumerate(policy_logits[0])}
-
-
 class Dynamics(Model, ABC):
-    def __init__(self, hidden_state_size: int, enc_space_size: int):
+    def __init__(self, hidden_state_size: int, enc_space_size: int, dtype: tf.DType = tf.float32):
         """
         r^k, s^k = g_0(s^(k-1), a^k)
         :param enc_space_size: size of hidden state
         """
-        super(Dynamics, self).__init__()
+        super(Dynamics, self).__init__(dtype=dtype)
         neurons = 20
         reward_initializer = Zeros()
-        self.s_inputs = Dense(enc_space_size,
-                              input_shape=(enc_space_size,),
-                              name="g_s_input")
-        self.s_hidden = Dense(neurons,
-                              name="g_s_hidden")
+        # The state and reward heads share one trunk.
+        self.inputs = Dense(enc_space_size,
+                            input_shape=(enc_space_size,),
+                            name="g_inputs",
+                            dtype=dtype)
+        self.hidden = Dense(neurons,
+                            name="g_hidden",
+                            dtype=dtype)
+
         self.s_k = Dense(hidden_state_size,
                          activation=tf.nn.tanh,
-                         name="g_s_k")
-
-        self.r_inputs = Dense(enc_space_size,
-                              input_shape=(enc_space_size,),
-                              kernel_initializer=reward_initializer,
-                              name="g_r_input")
-        self.r_hidden = Dense(neurons,
-                              kernel_initializer=reward_initializer,
-                              name="g_r_hidden")
+                         name="g_s_k",
+                         dtype=dtype)
         self.r_k = Dense(41,
                          kernel_initializer=reward_initializer,
-                         name="g_r_k")
+                         name="g_r_k",
+                         dtype=dtype)
 
-    @tf.function
     def call(self, encoded_space, **kwargs):
         """
         :param **kwargs:
         :param encoded_space: hidden state concatenated with one_hot action
-        :return: NetworkOutput with reward (r^k) and hidden state (s^k)
+        :return: hidden state (s^k) and reward support logits (r^k)
         """
-        s = self.s_inputs(encoded_space)
-        s = self.s_hidden(s)
-        s_k = self.s_k(s)
+        x = self.inputs(encoded_space)
+        x = self.hidden(x)
 
-        r = self.r_inputs(encoded_space)
-        r = self.r_hidden(r)
-        r_k = self.r_k(r)
+        s_k = self.s_k(x)
+        r_k = self.r_k(x)
 
         return s_k, r_k
 
 
 class Prediction(Model, ABC):
-    def __init__(self, action_state_size: int, hidden_state_size: int):
+    def __init__(self, action_state_size: int, hidden_state_size: int, dtype: tf.DType = tf.float32):
         """
         p^k, v^k = f_0(s^k)
         :param action_state_size: size of action state
         """
-        super(Prediction, self).__init__()
+        super(Prediction, self).__init__(dtype=dtype)
         neurons = 20
         policy_initializer = RandomUniform(minval=0., maxval=1.)
         value_initializer = Zeros()
-        self.p_inputs = Dense(hidden_state_size,
-                              input_shape=(hidden_state_size,),
-                              kernel_initializer=policy_initializer,
-                              name="f_p_inputs")
-        self.p_hidden = Dense(neurons,
-                              kernel_initializer=policy_initializer,
-                              name="f_p_hidden")
+        # The policy and value heads share one trunk.
+        self.inputs = Dense(hidden_state_size,
+                            input_shape=(hidden_state_size,),
+                            kernel_initializer=policy_initializer,
+                            name="f_inputs",
+                            dtype=dtype)
+        self.hidden = Dense(neurons,
+                            kernel_initializer=policy_initializer,
+                            name="f_hidden",
+                            dtype=dtype)
+
         self.policy = Dense(action_state_size,
                             kernel_initializer=policy_initializer,
-                            name="f_policy")
-
-        self.v_inputs = Dense(hidden_state_size,
-                              input_shape=(hidden_state_size,),
-                              kernel_initializer=value_initializer,
-                              name="f_v_inputs")
-        self.v_hidden = Dense(neurons,
-                              kernel_initializer=value_initializer,
-                              name="f_v_hidden")
+                            name="f_policy",
+                            dtype=dtype)
         self.value = Dense(41,
                            kernel_initializer=value_initializer,
-                           name="f_value")
+                           name="f_value",
+                           dtype=dtype)
 
-    @tf.function
     def call(self, hidden_state, **kwargs):
         """
         :param hidden_state
-        :return: NetworkOutput with policy logits and value
+        :return: policy logits and value support logits
         """
-        p = self.p_inputs(hidden_state)
-        p = self.p_hidden(p)
-        policy = self.policy(p)
+        x = self.inputs(hidden_state)
+        x = self.hidden(x)
 
-        v = self.v_inputs(hidden_state)
-        v = self.v_hidden(v)
-        value = self.value(v)
+        policy = self.policy(x)
+        value = self.value(x)
 
         return policy, value
 
 
 class Representation(Model, ABC):
-    def __init__(self, obs_space_size: int):
+    def __init__(self, obs_space_size: int, dtype: tf.DType = tf.float32):
         """
         s^0 = h_0(o_1,...,o_t)
         :param obs_space_size
         """
-        super(Representation, self).__init__()
+        super(Representation, self).__init__(dtype=dtype)
         neurons = 20
         self.inputs = Dense(obs_space_size,
                             input_shape=(obs_space_size,),
-                            name="h_inputs")
+                            name="h_inputs",
+                            dtype=dtype)
         self.hidden = Dense(neurons,
-                            name="h_hidden1")
+                            name="h_hidden1",
+                            dtype=dtype)
         self.s0 = Dense(obs_space_size,
                         activation=tf.nn.tanh,
-                        name="h_s0")
+                        name="h_s0",
+                        dtype=dtype)
 
-    @tf.function
     def call(self, observation, **kwargs):
         """
         :param observation
@@ -147,97 +131,198 @@ class Representation(Model, ABC):
 
 
 class Network(object):
-    def __init__(self, config: MuZeroConfig):
+    def __init__(self, config: MuZeroConfig, dtype='float32'):
+        """
+        :param config: MuZero configuration
+        :param dtype: dtype or Keras dtype policy name of the submodels, e.g. tf.bfloat16 or 'mixed_float16'
+        """
         self.config = config
-        self.g_dynamics = Dynamics(config.state_space_size, config.action_space_size + config.state_space_size)
-        self.f_prediction = Prediction(config.action_space_size, config.state_space_size)
-        self.h_representation = Representation(config.state_space_size)
+        # Activations are computed in the policy's compute dtype; inputs and outputs are always float32.
+        self.policy = Policy(dtype if isinstance(dtype, str) else tf.as_dtype(dtype).name)
+        self.dtype = tf.as_dtype(self.policy.compute_dtype)
+        self.g_dynamics = Dynamics(config.state_space_size, config.action_space_size + config.state_space_size,
+                                   dtype=self.policy)
+        self.f_prediction = Prediction(config.action_space_size, config.state_space_size, dtype=self.policy)
+        self.h_representation = Representation(config.state_space_size, dtype=self.policy)
         self._training_steps = 0
-
-        self.g_dynamics_checkpoint = tf.train.Checkpoint(model=self.g_dynamics)
-        self.f_prediction_checkpoint = tf.train.Checkpoint(model=self.f_prediction)
-        self.h_representation_checkpoint = tf.train.Checkpoint(model=self.h_representation)
-
-        self.g_dynamics_checkpoint_path = './checkpoints/muzero/Dynamics'
-        Path.mkdir(Path(self.g_dynamics_checkpoint_path), parents=True, exist_ok=True)
-        self.manager_dynamics = tf.train.CheckpointManager(self.g_dynamics_checkpoint,
-                                                           directory=self.g_dynamics_checkpoint_path,
-                                                           max_to_keep=5)
-
-        self.f_prediction_checkpoint_path = './checkpoints/muzero/Prediction'
-        Path.mkdir(Path(self.f_prediction_checkpoint_path), parents=True, exist_ok=True)
-        self.manager_prediction = tf.train.CheckpointManager(self.f_prediction_checkpoint,
-                                                             directory=self.f_prediction_checkpoint_path,
-                                                             max_to_keep=5)
-
-        self.h_representation_checkpoint_path = './checkpoints/muzero/Representation'
-        Path.mkdir(Path(self.h_representation_checkpoint_path), parents=True, exist_ok=True)
-        self.manager_representation = tf.train.CheckpointManager(self.h_representation_checkpoint,
-                                                                 directory=self.h_representation_checkpoint_path,
-                                                                 max_to_keep=5)
+        self._last_saved_step = None
+        self._restored_path = None
+        self._built = False
+        # Rows of the identity are the one-hot encodings of the actions.
+        self._eye = tf.cast(np.eye(config.action_space_size, dtype=np.float32), self.dtype)
+
+        # Whole inference steps are traced once, so each batch of MCTS expansions is a single graph call,
+        # and compiled with XLA so the chained Dense layers of each submodel are fused.
+        batch_state_spec = tf.TensorSpec([None, config.state_space_size], tf.float32)
+        self._initial_batch = tf.function(self._initial_batch_step,
+                                          input_signature=[batch_state_spec],
+                                          experimental_compile=True)
+        self._recurrent_batch = tf.function(self._recurrent_batch_step,
+                                            input_signature=[batch_state_spec, tf.TensorSpec([None], tf.int32)],
+                                            experimental_compile=True)
+
+        # The three submodels are saved as one checkpoint, so a reader never sees them at different steps.
+        self.checkpoint = tf.train.Checkpoint(dynamics=self.g_dynamics,
+                                              prediction=self.f_prediction,
+                                              representation=self.h_representation)
+        self.checkpoint_path = './checkpoints/muzero'
+        Path.mkdir(Path(self.checkpoint_path), parents=True, exist_ok=True)
+        self.manager = tf.train.CheckpointManager(self.checkpoint,
+                                                  directory=self.checkpoint_path,
+                                                  max_to_keep=5)
 
     def save_checkpoint(self):
-        self.manager_dynamics.save()
-        self.manager_prediction.save()
-        self.manager_representation.save()
-
-    def restore_checkpoint(self):
-        self.g_dynamics_checkpoint.restore(self.manager_dynamics.latest_checkpoint)
-        self.f_prediction_checkpoint.restore(self.manager_prediction.latest_checkpoint)
-        self.h_representation_checkpoint.restore(self.manager_representation.latest_checkpoint)
-
-    def prepare_observation(self, observation: tf.Tensor) -> tf.Tensor:
-        observation = tf.expand_dims(observation, 0)
-        # observation = scale(observation)
-        observation = tf.cast(observation, dtype=tf.float32)
-        return observation
-
-    def initial_inference(self, observation) -> NetworkOutput:
-        # representation + prediction function
+        # Weights only change through training steps, so an unchanged counter means nothing new to write.
+        training_steps = self._training_steps
+        if training_steps == self._last_saved_step:
+            return
+        self.manager.save(checkpoint_number=training_steps)
+        self._last_saved_step = training_steps
+
+    def restore_checkpoint(self) -> bool:
+        """
+        Load the latest checkpoint on disk into this network, unless it is the one already loaded
+        :return: whether new weights were loaded
+        """
+        # The manager only knows about its own saves, so the latest checkpoint is looked up on disk.
+        # Weights are created first so the values are assigned now rather than on a deferred first call.
+        self.build()
+        path = tf.train.latest_checkpoint(self.checkpoint_path)
+        if path is None or path == self._restored_path:
+            return False
+        self.checkpoint.restore(path)
+        self._restored_path = path
+        return True
+
+    def initial_step(self, observation: tf.Tensor):
+        """
+        Representation + prediction on a batch, differentiable and traceable
+        :param observation: [B, obs_dim] float32 observations
+        :return: hidden states s^0 [B, H], policy logits [B, A] and value support logits [B, 41]
+        """
         # representation
-        observation = self.prepare_observation(observation)
-
-        s_0 = self.h_representation(observation)
-        # s_0 = scale(s_0)
+        s_0 = self.h_representation(tf.cast(observation, self.dtype))
 
         # prediction
         p, v = self.f_prediction(s_0)
 
-        v = tf_support_to_scalar(v, 20)
-
-        return NetworkOutput(
-            value=float(v.numpy()),
-            reward=0.0,
-            policy_logits=build_policy_logits(policy_logits=p),
-            hidden_state=s_0,
-        )
-
-    @tf.function
-    def encode_state(self, hidden_state: tf.Tensor, action: int, action_space_size: int) -> tf.Tensor:
-        one_hot = tf.expand_dims(tf.one_hot(action, action_space_size), 0)
-        encoded_state = tf.concat([hidden_state, one_hot], axis=1)
-        return encoded_state
+        return tf.cast(s_0, tf.float32), tf.cast(p, tf.float32), tf.cast(v, tf.float32)
 
-    def recurrent_inference(self, hidden_state, action: Action) -> NetworkOutput:
-        # dynamics + prediction function
+    def recurrent_step(self, hidden_state: tf.Tensor, action: tf.Tensor):
+        """
+        Dynamics + prediction on a batch, differentiable and traceable
+        :param hidden_state: [B, H] hidden states s^(k-1)
+        :param action: [B] int32 actions a^k
+        :return: hidden states s^k [B, H], reward support logits [B, 41], policy logits [B, A]
+                 and value support logits [B, 41]
+        """
         # dynamics (encoded_state)
-        encoded_state = self.encode_state(hidden_state, action.index, self.config.action_space_size)
+        one_hot = tf.gather(self._eye, action)
+        encoded_state = tf.concat([tf.cast(hidden_state, self.dtype), one_hot], axis=1)
 
+        # s^k is already bounded by the tanh output of Dynamics, so it is not rescaled.
         s_k, r_k = self.g_dynamics(encoded_state)
-        # s_k = scale(s_k)
-
-        r_k = tf_support_to_scalar(r_k, 20)
 
         # prediction
         p, v = self.f_prediction(s_k)
-        v = tf_support_to_scalar(v, 20)
 
-        return NetworkOutput(
-            value=float(v.numpy()),
-            reward=float(r_k.numpy()),
-            policy_logits=build_policy_logits(policy_logits=p),
-            hidden_state=s_k
-        )
+        return tf.cast(s_k, tf.float32), tf.cast(r_k, tf.float32), tf.cast(p, tf.float32), tf.cast(v, tf.float32)
+
+    @staticmethod
+    def _to_scalar(support_logits: tf.Tensor) -> tf.Tensor:
+        # Value and reward heads output logits over the support; the scalar is the expectation.
+        return tf_support_to_scalar(tf.nn.softmax(support_logits), 20)
+
+    def _initial_inference_step(self, observation: tf.Tensor):
+        s_0, p, v = self.initial_step(observation)
+        return s_0, p, self._to_scalar(v)
+
+    def _recurrent_inference_step(self, hidden_state: tf.Tensor, action: tf.Tensor):
+        s_k, r_k, p, v = self.recurrent_step(hidden_state, action)
+        return s_k, self._to_scalar(r_k), p, self._to_scalar(v)
+
+    # The batched steps pack everything MCTS reads on the host into one
+    # [B, A + 2 + H] tensor (policy logits, value, reward, hidden state), so it is copied back at once.
+    def _initial_batch_step(self, observation: tf.Tensor):
+        s_0, p, v = self._initial_inference_step(observation)
+        return tf.concat([p, tf.expand_dims(v, 1), tf.zeros_like(tf.expand_dims(v, 1)), s_0], axis=1)
+
+    def _recurrent_batch_step(self, hidden_state: tf.Tensor, action: tf.Tensor):
+        s_k, r_k, p, v = self._recurrent_inference_step(hidden_state, action)
+        return tf.concat([p, tf.expand_dims(v, 1), tf.expand_dims(r_k, 1), s_k], axis=1)
+
+    @staticmethod
+    def _pad(rows: np.ndarray, batch_size: Optional[int]) -> np.ndarray:
+        # Each batch shape is a separate XLA compile, so short batches are padded with zero rows.
+        if batch_size is None or len(rows) >= batch_size:
+            return rows
+        padding = np.zeros((batch_size - len(rows),) + rows.shape[1:], dtype=rows.dtype)
+        return np.concatenate([rows, padding])
+
+    def _unpack(self, outputs: tf.Tensor, count: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        outputs = outputs.numpy()[:count]
+        action_space_size = self.config.action_space_size
+        return (outputs[:, :action_space_size],
+                outputs[:, action_space_size],
+                outputs[:, action_space_size + 1],
+                outputs[:, action_space_size + 2:])
+
+    def initial_inference_batch(self, observations, batch_size: Optional[int] = None) \
+            -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Evaluate several roots with a single representation + prediction call
+        :param observations: [B, obs_dim] float32 observations
+        :param batch_size: if given, the call is padded to this many rows so any B <= batch_size reuses one compile
+        :return: policy logits [B, A], values [B], rewards [B] (zeros) and hidden states [B, H] as NumPy arrays
+        """
+        observations = np.asarray(observations, dtype=np.float32)
+        outputs = self._initial_batch(self._pad(observations, batch_size))
+        return self._unpack(outputs, len(observations))
+
+    def recurrent_inference_batch(self, hidden_states, actions: List[int], batch_size: Optional[int] = None) \
+            -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Evaluate several leaves with a single dynamics + prediction call
+        :param hidden_states: [B, state_space_size] hidden states of the parents
+        :param actions: the B actions to expand
+        :param batch_size: if given, the call is padded to this many rows so any B <= batch_size reuses one compile
+        :return: policy logits [B, A], values [B], rewards [B] and hidden states [B, H] as NumPy arrays
+        """
+        hidden_states = np.asarray(hidden_states, dtype=np.float32)
+        actions = np.asarray(actions, dtype=np.int32)
+        outputs = self._recurrent_batch(self._pad(hidden_states, batch_size), self._pad(actions, batch_size))
+        return self._unpack(outputs, len(actions))
+
+    def build(self):
+        # Subclassed models only create their weights on the first call.
+        if self._built:
+            return
+        self._built = True
+        # One eager call creates the weights without tracing or compiling the inference functions,
+        # which networks that are only saved or assigned never use.
+        s_0, _, _ = self.initial_step(tf.zeros([1, self.config.state_space_size]))
+        self.recurrent_step(s_0, tf.zeros([1], tf.int32))
+
+    def inference_copy(self, dtype: tf.DType) -> 'Network':
+        """
+        Copy of the network with its weights cast to dtype, for self-play only
+        :param dtype: e.g. tf.bfloat16, which halves the bytes read per inference
+        :return: Network
+        """
+        network = Network(self.config, dtype=dtype)
+        network.assign_weights(self)
+        return network
+
+    def assign_weights(self, source: 'Network'):
+        """
+        Overwrite the weights and training step counter with those of source
+        :param source: Network with the same config, its weights are cast to this network's variable dtype
+        """
+        source.build()
+        self.build()
+        for weights, target in zip(source.get_weights(), self.get_weights()):
+            target.assign(tf.cast(weights, target.dtype))
+        self._training_steps = source._training_steps
 
     def get_weights(self) -> List:
         networks = [self.g_dynamics, self.f_prediction, self.h_representation]
@@ -245,17 +330,6 @@ class Network(object):
                 for variables_list in map(lambda n: n.weights, networks)
                 for variables in variables_list]
 
-    def cb_get_variables(self) -> Callable:
-        """Return a callback that return the trainable variables of the network."""
-
-        def get_variables():
-            networks = [self.g_dynamics, self.f_prediction, self.h_representation]
-            return [variables
-                    for variables_list in map(lambda n: n.weights, networks)
-                    for variables in variables_list]
-
-        return get_variables
-
     def get_networks(self) -> List:
         return [self.g_dynamics, self.f_prediction, self.h_representation]
 
@@ -268,9 +342,3 @@ class Network(object):
 
     def increment_training_steps(self):
         self._training_steps += 1
-
-    def get_variables_by_network(self):
-        return [[x.trainable_variables] for x in [self.g_dynamics, self.f_prediction, self.h_representation]]
-
-    def get_variables(self):
-        return [x.trainable_variables for x in [self.g_dynamics, self.f_prediction, self.h_representation]]
@@ -6,18 +6,20 @@ import tensorflow as tf
 
 from tqdm import trange
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 from threading import Thread
-from multiprocessing import Pool, cpu_count
+from typing import Callable, List
 
-from tensorflow.keras.optimizers import Adam
+from tensorflow.keras.mixed_precision import LossScaleOptimizer
+from tensorflow.keras.optimizers import SGD
 from tensorflow.python.keras.optimizer_v2.learning_rate_schedule import ExponentialDecay
 
 from config import MuZeroConfig
-from games.game import ReplayBuffer, Game, make_atari_config
-from mcts import Node, expand_node, backpropagate, add_exploration_noise, run_mcts, select_action
+from games.game import Batch, ReplayBuffer, Game, GameRecord, make_atari_config
+from mcts import initialize_root, run_mcts, select_action
 from models.network import Network
 from storage import SharedStorage
-from utils import MinMaxStats, tf_scalar_to_support
+from utils import SearchTree, tf_scalar_to_support
 from utils.exports import export_models
 
 
@@ -29,140 +31,222 @@ def write_summary_score(step):
         train_score_current.reset_states()
 
 
-def run_selfplay(config: MuZeroConfig, replay_buffer: ReplayBuffer):
-    with Pool(int(np.ceil(cpu_count() / 2))) as pool:
+def selfplay_dataset(config: MuZeroConfig) -> tf.data.Dataset:
+    """
+    Endless stream of finished game records produced by self-play
+    :param config: MuZero configuration
+    :return: Dataset of GameRecord, prefetched so games are played ahead of the consumer
+    """
+    def generate_games():
+        # A single producer plays config.num_actors games in lockstep, so every
+        # network call is batched across games instead of issued one leaf at a time.
+        # The networks and their compiled functions are built once on the self-play device. Each round
+        # only loads a checkpoint newer than the last one, refreshing the reduced precision replica in place.
+        with tf.device(config.selfplay_device):
+            network = Network(config)
+            replica = network
+            if config.selfplay_dtype != 'float32':
+                replica = network.inference_copy(tf.as_dtype(config.selfplay_dtype))
+        while True:
+            with tf.device(config.selfplay_device):
+                if network.restore_checkpoint() and replica is not network:
+                    replica.assign_weights(network)
+
+                games = play_games(config, replica, config.num_actors)
+            for game in games:
+                yield game.to_record(config.td_steps)
+
+    signature = GameRecord(
+        observations=tf.TensorSpec([None, config.state_space_size], tf.float32),
+        actions=tf.TensorSpec([None], tf.int32),
+        rewards=tf.TensorSpec([None], tf.float32),
+        child_visits=tf.TensorSpec([None, config.action_space_size], tf.float32),
+        value_targets=tf.TensorSpec([None], tf.float32))
+
+    options = tf.data.Options()
+    options.experimental_deterministic = False
+    dataset = tf.data.Dataset.from_generator(generate_games, output_signature=signature)
+    return dataset.prefetch(tf.data.experimental.AUTOTUNE).with_options(options)
+
+
+def batch_signature(config: MuZeroConfig) -> Batch:
+    batch_size, num_unroll_steps = config.batch_size, config.num_unroll_steps
+    return Batch(
+        observations=tf.TensorSpec([batch_size, config.state_space_size], tf.float32),
+        actions=tf.TensorSpec([batch_size, num_unroll_steps], tf.int32),
+        target_values=tf.TensorSpec([batch_size, num_unroll_steps + 1], tf.float32),
+        target_rewards=tf.TensorSpec([batch_size, num_unroll_steps + 1], tf.float32),
+        target_policies=tf.TensorSpec([batch_size, num_unroll_steps + 1, config.action_space_size], tf.float32),
+        mask=tf.TensorSpec([batch_size, num_unroll_steps + 1], tf.bool))
+
+
+def replay_dataset(config: MuZeroConfig, replay_buffer: ReplayBuffer) -> tf.data.Dataset:
+    """
+    Endless stream of training batches sampled from the replay buffer
+    :param config: MuZero configuration
+    :param replay_buffer: buffer to sample from, must not be empty
+    :return: Dataset of Batch, prefetched so the next batch is ready while the current step runs
+    """
+    def sample_batches():
         while True:
-            results = [pool.apply_async(func=play_game, args=(config,)) for _ in range(config.num_actors)]
-            for p in results:
-                game = p.get()
-                replay_buffer.save_game(game)
-                train_score_mean(tf.reduce_sum(game.rewards))
-                train_score_current(tf.reduce_sum(game.rewards))
+            yield replay_buffer.sample_batch(config.num_unroll_steps)
+
+    dataset = tf.data.Dataset.from_generator(sample_batches, output_signature=batch_signature(config))
+    return dataset.prefetch(tf.data.experimental.AUTOTUNE)
+
 
-    # game = play_game(config, network)
-    # train_score_mean(tf.reduce_sum(game.rewards))
-    # train_score_current(tf.reduce_sum(game.rewards))
-    # replay_buffer.save_game(game)
+def run_selfplay(config: MuZeroConfig, replay_buffer: ReplayBuffer):
+    for record in selfplay_dataset(config):
+        record = tf.nest.map_structure(lambda t: t.numpy(), record)
+        replay_buffer.save_game(record)
+        # Rewards are already a float32 array; sum them once for both running means.
+        score = float(record.rewards.sum())
+        train_score_mean(score)
+        train_score_current(score)
 
 
 # Each game is produced by starting at the initial board position, then
 # repeatedly executing a Monte Carlo Tree Search to generate moves until the end
 # of the game is reached.
-def play_game(config: MuZeroConfig) -> Game:
-    game = Game(config.discount)
-    network = Network(config)
-    network.restore_checkpoint()
-
-    while not game.terminal() and len(game.history) < config.max_moves:
-        min_max_stats = MinMaxStats(config.known_bounds)
-
+def play_games(config: MuZeroConfig, network: Network, num_games: int) -> List[Game]:
+    games = [Game(config.discount, config.max_moves) for _ in range(num_games)]
+    # Each game keeps one search tree, cleared and reused for every move.
+    playing = [(game, SearchTree(config.action_space_size, config.state_space_size,
+                                 config.num_simulations, config.known_bounds))
+               for game in games]
+
+    while playing:
         # At the root of the search tree we use the representation function to
         # obtain a hidden state given the current observation.
-        root = Node(0)
-        current_observation = game.make_image(-1)
-        network_output = network.initial_inference(current_observation)
-        expand_node(root, game.to_play(), game.legal_actions(), network_output)
-        backpropagate([root], network_output.value, game.to_play(), config.discount, min_max_stats)
-        add_exploration_noise(config, root)
+        observations = np.concatenate([game.make_image(game.step_idx) for game, _ in playing])
+        policy_logits, values, _, hidden_states = network.initial_inference_batch(observations,
+                                                                                  batch_size=config.num_actors)
+        for i, (game, tree) in enumerate(playing):
+            tree.reset()
+            initialize_root(config, tree, game.legal_actions(), values[i], policy_logits[i], hidden_states[i])
 
         # We then run a Monte Carlo Tree Search using only action sequences and the
         # model learned by the network.
-        run_mcts(config, root, game.action_history(), network, min_max_stats)
-        action = select_action(root, network)
-        game.apply(action)
-        game.store_search_statistics(root)
+        trees = [tree for _, tree in playing]
+        run_mcts(config, trees, [game.action_history() for game, _ in playing], network)
+        for game, tree in playing:
+            action = select_action(tree, network)
+            game.store_search_statistics(tree)
+            game.apply(action)
+
+        playing = [(game, tree) for game, tree in playing
+                   if not game.terminal() and game.step_idx < config.max_moves]
 
-    return game
+    return games
 
 
 def train_network(config: MuZeroConfig,
                   storage: SharedStorage,
                   replay_buffer: ReplayBuffer):
-    network = Network(config)
+    with tf.device(config.training_device):
+        network = Network(config, dtype=config.training_dtype)
+        network.build()
 
     lr_schedule = ExponentialDecay(
         initial_learning_rate=config.lr_init,
         decay_steps=config.lr_decay_steps,
         decay_rate=config.lr_decay_rate
     )
-    optimizer = Adam(learning_rate=lr_schedule)
+    optimizer = SGD(learning_rate=lr_schedule, momentum=config.momentum)
+    if network.policy.compute_dtype == 'float16':
+        # float16 gradients underflow without loss scaling.
+        optimizer = LossScaleOptimizer(optimizer)
+    loss_fn = make_loss_fn(config, network)
+    replay_buffer.update_main()
+    batches = iter(replay_dataset(config, replay_buffer))
+    # Checkpoints are written from a host copy of the weights on a background thread, so disk I/O
+    # overlaps the next training steps without reading the variables they update.
+    with tf.device('/CPU:0'):
+        checkpoint_network = Network(config)
+        checkpoint_network.build()
+    checkpoint_writer = ThreadPoolExecutor(max_workers=1)
+    checkpoint_saved = None
 
     t = trange(config.training_steps, desc='Training', leave=True)
     for i in t:
-
         desc = f"Games (training/played): " \
-               f"{len(replay_buffer.buffer_tmp)}/{len(replay_buffer.buffer_tmp)} - " \
+               f"{replay_buffer.num_games}/{len(replay_buffer.buffer_tmp)} - " \
                f"Score Mean: {float(train_score_mean.result()):.2f}"
-
-        if i > 0:
-            desc = f"Games (training/played): " \
-                   f"{len(replay_buffer.buffer)}/{len(replay_buffer.buffer_tmp)} - " \
-                   f"Score Mean: {float(train_score_mean.result()):.2f}"
-
         t.set_description(desc)
         t.refresh()
 
         if i % config.checkpoint_interval == 0:
             storage.save_network(i, network)
-            network.save_checkpoint()
+            if checkpoint_saved is not None:
+                # Surfaces errors of the previous save, and keeps the copy from changing while it is written.
+                checkpoint_saved.result()
+            checkpoint_network.assign_weights(network)
+            checkpoint_saved = checkpoint_writer.submit(checkpoint_network.save_checkpoint)
             replay_buffer.update_main()
 
-        batch = replay_buffer.sample_batch(config.num_unroll_steps, config.td_steps)
-        loss = update_weights(optimizer, network, batch, config.weight_decay)
-        train_loss(loss)
+        batch = next(batches)
+        with tf.device(config.training_device):
+            update_weights(optimizer, network, loss_fn, batch)
         write_summary_score(i)
 
+    if checkpoint_saved is not None:
+        checkpoint_saved.result()
+    checkpoint_writer.shutdown()
     storage.save_network(config.training_steps, network)
 
 
 def scale_gradient(tensor, scale):
     """Scales the gradient for the backward pass."""
+    if isinstance(scale, (int, float)) and scale == 1.0:
+        return tensor
     return tensor * scale + tf.stop_gradient(tensor) * (1 - scale)
 
 
-def scalar_loss(prediction, target):
-    target = tf.experimental.numpy.atleast_2d(target)
-    prediction = tf.experimental.numpy.atleast_2d(prediction)
-
-    target = tf_scalar_to_support(target, 20)
-    prediction = tf_scalar_to_support(prediction, 20)
+def scalar_loss(prediction_logits, target):
+    """
+    Cross-entropy between the support projection of the targets and the predicted support logits
+    :param prediction_logits: [B, 41] value or reward support logits
+    :param target: [B] scalar targets
+    :return: [B] losses
+    """
+    return tf.nn.softmax_cross_entropy_with_logits(logits=prediction_logits, labels=tf_scalar_to_support(target, 20))
 
-    res = tf.cast(tf.nn.softmax_cross_entropy_with_logits(logits=prediction, labels=target), dtype=tf.float32)
-    return res
 
+def compute_loss(network: Network, batch: Batch, weight_decay: float):
+    mask = tf.cast(batch.mask, tf.float32)
+    # As in the baseline, each sample unrolls min(K, positions left) actions and its recurrent
+    # steps are scaled by their inverse, but only steps reaching a position still in the game are
+    # trained: the absorbing state past the end of the game is skipped.
+    num_actions = tf.reduce_sum(mask[:, :-1], axis=1)
 
-def compute_loss(network: Network, batch, weight_decay: float):
-    loss = 0
-    for image, actions, targets in batch:
-        # Initial step, from the real observation.
-        network_output = network.initial_inference(image)
-        hidden_state = network_output.hidden_state
-        predictions = [(1.0, network_output)]
+    # Initial step, from the real observation.
+    hidden_state, policy_logits, value = network.initial_step(batch.observations)
+    predictions = [(value, None, policy_logits)]
 
-        # Recurrent steps, from action and previous hidden state.
-        for action in actions:
-            network_output = network.recurrent_inference(hidden_state, action)
-            hidden_state = network_output.hidden_state
-            predictions.append((1.0 / len(actions), network_output))
+    # Recurrent steps, from action and previous hidden state.
+    # The unroll length is static, so the loop is unrolled into a single graph.
+    for k in range(batch.actions.shape[1]):
+        hidden_state, reward, policy_logits, value = network.recurrent_step(hidden_state, batch.actions[:, k])
+        predictions.append((value, reward, policy_logits))
 
-            hidden_state = scale_gradient(hidden_state, 0.5)
+        hidden_state = scale_gradient(hidden_state, 0.5)
 
-        for k, (prediction, target) in enumerate(zip(predictions, targets)):
-            gradient_scale, network_output = prediction
-            target_value, target_reward, target_policy = target
+    initial_loss, recurrent_loss = 0, 0
+    for k, prediction in enumerate(predictions):
+        value, reward, policy_logits = prediction
 
-            if not target_policy:  # How to treat absorbing states? Just pass?
-                continue
+        local_loss = tf.nn.softmax_cross_entropy_with_logits(
+            logits=policy_logits, labels=batch.target_policies[:, k])
 
-            local_loss = tf.nn.softmax_cross_entropy_with_logits(
-                logits=tf.stack(list(network_output.policy_logits.values())), labels=target_policy)
+        local_loss += scalar_loss(value, batch.target_values[:, k])
+        if k > 0:
+            local_loss += scalar_loss(reward, batch.target_rewards[:, k])
+            recurrent_loss += local_loss * mask[:, k]
+        else:
+            initial_loss = local_loss
 
-            local_loss += scalar_loss(network_output.value, target_value)
-            if k > 0:
-                local_loss += scalar_loss(network_output.reward, target_reward)
-
-            loss += scale_gradient(local_loss, gradient_scale)
-    loss /= len(batch)
+    # All recurrent steps of a sample share one gradient scale, so it is applied once to their sum.
+    loss = tf.reduce_mean(initial_loss + scale_gradient(recurrent_loss, 1.0 / num_actions))
 
     for weights in network.get_weights():
         loss += weight_decay * tf.nn.l2_loss(weights)
@@ -170,17 +254,34 @@ def compute_loss(network: Network, batch, weight_decay: float):
     return loss
 
 
+def make_loss_fn(config: MuZeroConfig, network: Network) -> Callable:
+    """
+    Trace compute_loss once for the batch shapes of config, compiled with XLA
+    :param config: MuZero configuration
+    :param network: network whose weights the loss is computed with
+    :return: function mapping a Batch to the scalar loss
+    """
+    def loss_fn(batch: Batch):
+        return compute_loss(network, batch, config.weight_decay)
+
+    return tf.function(loss_fn, input_signature=[batch_signature(config)], experimental_compile=True)
+
+
 def get_variables(network):
     parts = (network.f_prediction, network.g_dynamics, network.h_representation)
     return [v for v_list in map(lambda n: n.trainable_weights, parts) for v in v_list]
 
 
-def update_weights(optimizer: tf.optimizers.Optimizer, network: Network, batch, weight_decay: float):
+def update_weights(optimizer: tf.optimizers.Optimizer, network: Network, loss_fn: Callable, batch: Batch):
+    scaled = isinstance(optimizer, LossScaleOptimizer)
     with tf.GradientTape() as tape:
-        loss = compute_loss(network, batch, weight_decay)
+        loss = loss_fn(batch)
+        scaled_loss = optimizer.get_scaled_loss(loss) if scaled else loss
 
     train_loss(loss)
-    grads = tape.gradient(loss, get_variables(network))
+    grads = tape.gradient(scaled_loss, get_variables(network))
+    if scaled:
+        grads = optimizer.get_unscaled_gradients(grads)
     optimizer.apply_gradients(zip(grads, get_variables(network)))
 
     network.increment_training_steps()
@@ -194,8 +295,7 @@ def muzero(config: MuZeroConfig):
     thread_games = Thread(target=run_selfplay, args=(config, replay_buffer))
     thread_games.start()
 
-    while len(replay_buffer.buffer_tmp) < 1:
-        pass
+    replay_buffer.ready.wait()
 
     train_network(config, storage, replay_buffer)
     export_models(storage.latest_network())
@@ -1,3 +1,5 @@
+from threading import Lock
+
 from config import MuZeroConfig
 from models.network import Network
 
@@ -6,14 +8,19 @@ class SharedStorage(object):
 
     def __init__(self, config: MuZeroConfig):
         self.config = config
-        self._networks = {}
+        # (step, network) of the most recent save, swapped as a whole under the lock.
+        self._latest = None
+        self._lock = Lock()
 
     def latest_network(self) -> Network:
-        if self._networks:
-            return self._networks[max(self._networks.keys())]
+        latest = self._latest
+        if latest is not None:
+            return latest[1]
         else:
             # policy -> uniform, value -> 0, reward -> 0
             return Network(self.config)
 
     def save_network(self, step: int, network: Network):
-        self._networks[step] = network
+        with self._lock:
+            if self._latest is None or step >= self._latest[0]:
+                self._latest = (step, network)
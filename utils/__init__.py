@@ -2,10 +2,14 @@ import collections
 import typing
 from typing import Optional
 
+import numpy as np
 import tensorflow as tf
 
 MAXIMUM_FLOAT_VALUE = float('inf')
 
+# Support vectors [-support_size, ..., support_size], built once per size.
+_SUPPORT_CACHE = {}
+
 
 KnownBounds = collections.namedtuple('KnownBounds', ['min', 'max'])
 
@@ -14,8 +18,12 @@ class MinMaxStats(object):
     """A class that holds the min-max values of the tree."""
 
     def __init__(self, known_bounds: Optional[KnownBounds]):
-        self.maximum = known_bounds.max if known_bounds else -MAXIMUM_FLOAT_VALUE
-        self.minimum = known_bounds.min if known_bounds else MAXIMUM_FLOAT_VALUE
+        self.known_bounds = known_bounds
+        self.reset()
+
+    def reset(self):
+        self.maximum = self.known_bounds.max if self.known_bounds else -MAXIMUM_FLOAT_VALUE
+        self.minimum = self.known_bounds.min if self.known_bounds else MAXIMUM_FLOAT_VALUE
 
     def update(self, value: float):
         self.maximum = max(self.maximum, value)
@@ -28,24 +36,44 @@ class MinMaxStats(object):
         return value
 
 
-class Node(object):
-
-    def __init__(self, prior: float):
-        self.visit_count = 0
-        self.to_play = -1
-        self.prior = prior
-        self.value_sum = 0
-        self.children = {}
-        self.hidden_state = None
-        self.reward = 0
-
-    def expanded(self) -> bool:
-        return len(self.children) > 0
-
-    def value(self) -> float:
-        if self.visit_count == 0:
-            return 0
-        return self.value_sum / self.visit_count
+class SearchTree(object):
+    """Search tree stored as preallocated arrays indexed by node id, the root being node 0.
+
+    A search expands the root and then one leaf per simulation, each expansion
+    adding one child per action, so the arrays are sized once and reused for
+    every move of a game.
+    """
+
+    ROOT = 0
+
+    def __init__(self, action_space_size: int, state_space_size: int, num_simulations: int,
+                 known_bounds: Optional[KnownBounds]):
+        max_nodes = 1 + (num_simulations + 1) * action_space_size
+        self.visit_count = np.zeros(max_nodes, dtype=np.int32)
+        self.value_sum = np.zeros(max_nodes)
+        self.prior = np.zeros(max_nodes)
+        self.reward = np.zeros(max_nodes)
+        self.expanded = np.zeros(max_nodes, dtype=bool)
+        # children[node, action] is the id of the child reached by action, -1 if illegal or not expanded.
+        self.children = np.full((max_nodes, action_space_size), -1, dtype=np.int32)
+        self.hidden_state = np.zeros((max_nodes, state_space_size), dtype=np.float32)
+        self.num_nodes = 1
+        self.min_max_stats = MinMaxStats(known_bounds)
+
+    def reset(self):
+        used = self.num_nodes
+        self.visit_count[:used] = 0
+        self.value_sum[:used] = 0
+        self.prior[:used] = 0
+        self.reward[:used] = 0
+        self.expanded[:used] = False
+        self.children[:used] = -1
+        self.num_nodes = 1
+        self.min_max_stats.reset()
+
+    def value(self, node) -> np.ndarray:
+        visit_count = self.visit_count[node]
+        return np.where(visit_count > 0, self.value_sum[node] / np.maximum(visit_count, 1), 0.)
 
 
 @tf.function
@@ -55,7 +83,7 @@ def scalar_transform(x: float, eps: float = 0.001) -> tf.Tensor:
 
 @tf.function
 def inverse_scalar_transform(x: float, eps: float = 0.001) -> tf.Tensor:
-    return tf.math.sign(x) * (((tf.math.sqrt(1. + 4. * eps * (tf.math.abs(x) + 1 + eps)) - 1) / (2 * eps)) ** 2 - 1)
+    return tf.math.sign(x) * (((tf.math.sqrt(1. + 4. * eps * (tf.math.abs(x) + 1 + eps)) - 1) * (0.5 / eps)) ** 2 - 1)
 
 
 @tf.function
@@ -67,18 +95,14 @@ def tf_scalar_to_support(x: tf.Tensor,
 
     x = reward_transformer(x, **kwargs)
 
-    transformed = tf.clip_by_value(x, -support_size, support_size - 1e-6)
+    transformed = tf.clip_by_value(x, -support_size, support_size)
     floored = tf.floor(transformed)
-    prob = transformed - floored  # Proportion between adjacent integers
-
-    idx_0 = tf.expand_dims(tf.cast(tf.squeeze(floored + support_size), dtype=tf.int32), -1)
-    idx_1 = tf.expand_dims(tf.cast(tf.squeeze(floored + support_size + 1), dtype=tf.int32), -1)
-    idx_0 = tf.stack([tf.range(x.shape[1]), idx_0])
-    idx_1 = tf.stack([tf.range(x.shape[1]), idx_1])
-    indexes = tf.squeeze(tf.stack([idx_0, idx_1]))
+    prob = tf.expand_dims(transformed - floored, -1)  # Proportion between adjacent integers
 
-    updates = tf.squeeze(tf.concat([1 - prob, prob], axis=0))
-    return tf.scatter_nd(indexes, updates, (1, 2 * support_size + 1))
+    lower = tf.cast(floored, dtype=tf.int32) + support_size
+    upper = tf.minimum(lower + 1, 2 * support_size)
+    return (tf.one_hot(lower, 2 * support_size + 1, dtype=prob.dtype) * (1 - prob) +
+            tf.one_hot(upper, 2 * support_size + 1, dtype=prob.dtype) * prob)
 
 
 @tf.function
@@ -88,7 +112,10 @@ def tf_support_to_scalar(x: tf.Tensor, support_size: int,
     if support_size == 0:  # Simple regression (support in this case can be the mean of a Gaussian)
         return x
 
-    bins = tf.range(-support_size, support_size + 1, dtype=tf.float32)
-    value = tf.tensordot(tf.squeeze(x), tf.squeeze(bins), 1)
+    support = _SUPPORT_CACHE.get(support_size)
+    if support is None:
+        support = np.arange(-support_size, support_size + 1, dtype=np.float32)
+        _SUPPORT_CACHE[support_size] = support
+    value = tf.linalg.matvec(x, support)
 
     return inv_reward_transformer(value, **kwargs)